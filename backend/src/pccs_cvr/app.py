@@ -1,21 +1,34 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import FileResponse, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
+from typing import AsyncIterator, BinaryIO, DefaultDict, Dict, Iterable, List, Optional, Set, Tuple
 import shutil
 import os
+import asyncio
+import io
 from datetime import datetime
 import logging
 import zipfile
-from .main import fetch_k8s_resources, cleanse_k8s_resouces_csv, generate_final_report, fetch_wiz_container_vulnerabilities_report
-from time import sleep
+import json
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from .main import K8sRow, pod_cache, fetch_k8s_pods, iter_k8s_resources, iter_cleansed_k8s_resources, save_k8s_resouces_csv, cleanse_k8s_resouces_csv, generate_final_report, load_wiz_index
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Keep an in-memory pod list current via a K8s watch so /cvr never lists pods itself
+    pod_cache.start()
+    load_report_index()
+    yield
+    pod_cache.stop()
 
-from fastapi.middleware.cors import CORSMiddleware
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,31 +43,116 @@ DATA_DIR = os.getenv("DATA_DIR", "../data_cvr")
 RAW_DIR = os.path.join(DATA_DIR, "raws")
 REPORT_DIR = os.path.join(DATA_DIR, "reports")
 CLUSTER_NAME = os.getenv("CLUSTER_NAME", "cluster")
+# Save the raw and cleansed K8s snapshots next to the Wiz upload (for debugging)
+DEBUG_DUMP_RAW = os.getenv("DEBUG_DUMP_RAW", "false").lower() in ("1", "true", "yes")
 
 # Ensure directories exist
 os.makedirs(RAW_DIR, exist_ok=True)
 os.makedirs(REPORT_DIR, exist_ok=True)
 
+# Dates with a generated report, so /reports/all doesn't list REPORT_DIR on every call
+KNOWN_REPORT_DATES: Set[str] = set()
+# REPORT_DIR mtime when KNOWN_REPORT_DATES was last rebuilt; reports written by another
+# replica on the shared volume (or copied in by hand) change it
+report_index_mtime_ns: Optional[int] = None
+
+def load_report_index() -> None:
+    """Rebuilds KNOWN_REPORT_DATES from the report files in REPORT_DIR."""
+    global report_index_mtime_ns
+    # Stat before listing, so a file added in between triggers another rebuild
+    report_index_mtime_ns = os.stat(REPORT_DIR).st_mtime_ns
+    # Extract date from filename: YYYY-MM-DD-cvr.csv
+    dates = {f[:-len("-cvr.csv")] for f in os.listdir(REPORT_DIR) if f.endswith("-cvr.csv")}
+    KNOWN_REPORT_DATES.clear()
+    KNOWN_REPORT_DATES.update(dates)
+    logger.info("Indexed %s existing reports", len(dates))
+
+def refresh_report_index() -> None:
+    """Rebuilds KNOWN_REPORT_DATES if REPORT_DIR changed since it was last indexed."""
+    try:
+        mtime_ns = os.stat(REPORT_DIR).st_mtime_ns
+    except OSError:
+        return
+    if mtime_ns != report_index_mtime_ns:
+        load_report_index()
+
 class ReportRequest(BaseModel):
     date: str
 
+# Response models let FastAPI serialize replies straight to JSON bytes via Pydantic
+class UploadResult(BaseModel):
+    message: str
+    filename: str
+
+class ReportResult(BaseModel):
+    message: str
+    file_name: str
+
+class ReportDates(BaseModel):
+    dates: List[str]
+
+class HealthStatus(BaseModel):
+    status: str
+
+
+# Serializes the check/generate/sign steps of /cvr per report date
+report_locks: DefaultDict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Inputs each report was last generated from: date -> (Wiz CSV mtime_ns, Wiz CSV size, pod cache resourceVersion)
+report_signatures: Dict[str, tuple] = {}
+
+def report_signature(wiz_csv_path: str) -> Optional[Tuple[int, int, str]]:
+    """Returns the signature of the current report inputs, or None if K8s state is unknown."""
+    if pod_cache.resource_version is None:
+        return None
+    try:
+        # Nanosecond mtime plus size, so a quick re-upload is not mistaken for the same file
+        st = os.stat(wiz_csv_path)
+        return (st.st_mtime_ns, st.st_size, pod_cache.resource_version)
+    except OSError:
+        return None
+
+def load_report_signature(date_str: str, sig_path: str) -> Optional[tuple]:
+    """Returns the stored signature for a report, reading the .sig file after a restart."""
+    if date_str not in report_signatures:
+        try:
+            with open(sig_path, 'r', encoding='utf-8') as f:
+                report_signatures[date_str] = tuple(json.load(f))
+        except (OSError, ValueError):
+            return None
+    return report_signatures[date_str]
+
+def save_report_signature(date_str: str, sig_path: str, signature: tuple) -> None:
+    """Remembers the inputs a report was generated from, in memory and next to the report."""
+    report_signatures[date_str] = signature
+    try:
+        with open(sig_path, 'w', encoding='utf-8') as f:
+            json.dump(list(signature), f)
+    except OSError as e:
+        logger.warning("Failed to save report signature %s: %s", sig_path, e)
+
+def save_upload_file(src: BinaryIO, path: str) -> None:
+    """Copies an uploaded file to disk in 1 MiB chunks."""
+    with open(path, "wb+") as file_object:
+        shutil.copyfileobj(src, file_object, 1024 * 1024)
+
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...)) -> UploadResult:
     try:
         today = datetime.now().strftime("%Y-%m-%d")
         file_location = f"{RAW_DIR}/{today}-wiz.csv"
-        
-        with open(file_location, "wb+") as file_object:
-            shutil.copyfileobj(file.file, file_object)
-            
-        logger.info(f"File uploaded successfully to {file_location}")
-        return JSONResponse(content={"message": "File uploaded successfully", "filename": file_location}, status_code=200)
+
+        # Copy in a worker thread so large uploads don't block the event loop
+        await run_in_threadpool(save_upload_file, file.file, file_location)
+
+        logger.info("File uploaded successfully to %s", file_location)
+        return UploadResult(message="File uploaded successfully", filename=file_location)
     except Exception as e:
-        logger.error(f"Error uploading file: {e}")
+        logger.error("Error uploading file: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to upload file: {str(e)}")
 
 @app.post("/cvr")
-async def generate_report(request: ReportRequest):
+async def generate_report(request: ReportRequest, background_tasks: BackgroundTasks) -> ReportResult:
     date_str = request.date
     try:
         # Validate date format
@@ -65,78 +163,87 @@ async def generate_report(request: ReportRequest):
         k8s_csv_path = f"{RAW_DIR}/{date_str}-k8s.csv"
         report_base_path = f"{REPORT_DIR}/{date_str}-cvr"
         report_csv_path = f"{report_base_path}.csv"
+        report_md_path = f"{report_base_path}.md"
+        report_sig_path = f"{report_base_path}.sig"
 
-        # Check if Wiz file exists
-        if not os.path.exists(wiz_csv_path):
-            raise HTTPException(status_code=404, detail=f"Wiz report for {date_str} not found. Please upload it first.")
-        
-        # 1. Fetch K8s resources (using SDK)
-        logger.info("Fetching K8s resources...")
-        k8s_data = fetch_k8s_resources()
-        
-        # Save K8s raw data
-        import csv
-        if k8s_data:
-            keys = k8s_data[0].keys()
-            with open(k8s_csv_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=keys)
-                writer.writeheader()
-                writer.writerows(k8s_data)
-        
-        # 2. Cleanse K8s data
-        k8s_cleansed_data = cleanse_k8s_resouces_csv(k8s_data, f"{RAW_DIR}/{date_str}-k8s-cleansed.csv")
-        
-        # 3. Read Wiz data
-        wiz_data = fetch_wiz_container_vulnerabilities_report(wiz_csv_path)
+        # One generation per date at a time, so concurrent requests never rewrite the same report and .sig files
+        async with report_locks[date_str]:
+            # Skip regeneration if neither the Wiz upload nor the cluster changed since the last report
+            # and both report files (/download needs the Markdown too) are still there
+            signature = report_signature(wiz_csv_path)
+            reports_exist = os.path.exists(report_csv_path) and os.path.exists(report_md_path)
+            if reports_exist and signature is not None and load_report_signature(date_str, report_sig_path) == signature:
+                logger.info("Inputs unchanged, reusing report %s", report_csv_path)
+                return ReportResult(message="Report generated successfully", file_name=report_csv_path)
+
+            # Check if Wiz file exists
+            if not os.path.exists(wiz_csv_path):
+                raise HTTPException(status_code=404, detail=f"Wiz report for {date_str} not found. Please upload it first.")
         
-        # 4. Generate Final Report
-        generate_final_report(k8s_cleansed_data, wiz_data, report_base_path, date_str)
+            # 1. Fetch K8s pods (using SDK) and read Wiz data concurrently
+            logger.info("Fetching K8s resources...")
+            pods, wiz_index = await asyncio.gather(
+                run_in_threadpool(fetch_k8s_pods),
+                run_in_threadpool(load_wiz_index, wiz_csv_path)
+            )
+
+            # 2. Cleanse K8s data
+            k8s_cleansed_data: Iterable[K8sRow]
+            if DEBUG_DUMP_RAW:
+                k8s_data = await run_in_threadpool(list, iter_k8s_resources(pods))
+                cleansed_rows = await run_in_threadpool(cleanse_k8s_resouces_csv, k8s_data)
+                k8s_cleansed_data = cleansed_rows
+
+                # Nothing downstream reads the snapshots, so write them after the response is sent
+                background_tasks.add_task(save_k8s_resouces_csv, k8s_data, k8s_csv_path)
+                background_tasks.add_task(save_k8s_resouces_csv, cleansed_rows, f"{RAW_DIR}/{date_str}-k8s-cleansed.csv")
+            else:
+                # Without snapshots, stream container rows straight through cleansing into the join
+                k8s_cleansed_data = iter_cleansed_k8s_resources(iter_k8s_resources(pods))
+
+            # 3. Generate Final Report
+            await run_in_threadpool(generate_final_report, k8s_cleansed_data, wiz_index, report_base_path, date_str)
+            if signature is not None:
+                save_report_signature(date_str, report_sig_path, signature)
+            if os.path.exists(report_csv_path):
+                KNOWN_REPORT_DATES.add(date_str)
         
-        return JSONResponse(content={"message": "Report generated successfully", "file_name": report_csv_path}, status_code=200)
+        return ReportResult(message="Report generated successfully", file_name=report_csv_path)
 
     except HTTPException as he:
         raise he
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
     except Exception as e:
-        logger.error(f"Error generating report: {e}")
+        logger.error("Error generating report: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/reports/all")
-async def get_all_reports():
+async def get_all_reports() -> ReportDates:
     """Returns a list of available report dates."""
-    try:
-        files = os.listdir(REPORT_DIR)
-        dates = []
-        for f in files:
-            if f.endswith("-cvr.csv"):
-                # Extract date from filename: YYYY-MM-DD-cvr.csv
-                date_part = f.replace("-cvr.csv", "")
-                dates.append(date_part)
-        return {"dates": sorted(dates)}
-    except Exception as e:
-        logger.error(f"Error listing reports: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    refresh_report_index()
+    return ReportDates(dates=sorted(KNOWN_REPORT_DATES))
 
 @app.get("/reports/{date}")
-async def get_report(date: str):
+async def get_report(date: str) -> FileResponse:
     file_path = f"{REPORT_DIR}/{date}-cvr.csv"
-    if os.path.exists(file_path):
-        return FileResponse(file_path, media_type='text/csv', filename=f"{date}-cvr.csv")
-    else:
+    try:
+        # Stat once here and hand it to FileResponse so it doesn't stat the file again
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Report not found")
+    return FileResponse(file_path, media_type='text/csv', filename=f"{date}-cvr.csv", stat_result=stat_result)
 
-def cleanup_file(path: str):
-    """Deletes a file if it exists."""
-    try:
-        if os.path.exists(path):
-            os.remove(path)
-            logger.info(f"Deleted temporary file: {path}")
-    except Exception as e:
-        logger.warning(f"Failed to delete temporary file {path}: {e}")
+def build_zip(files: Iterable[Tuple[str, str]]) -> bytes:
+    """Returns the bytes of a zip archive holding the given (path, arcname) files."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        for path, arcname in files:
+            zipf.write(path, arcname=arcname)
+    return buffer.getvalue()
 
 @app.get("/download/{date}")
-async def download_zip(date: str, background_tasks: BackgroundTasks):
+async def download_zip(date: str) -> Response:
     """Generates and downloads a zip file containing the CSV and MD reports."""
     try:
         # Validate date
@@ -160,28 +267,24 @@ async def download_zip(date: str, background_tasks: BackgroundTasks):
             csv_arcname = f"{CLUSTER_NAME}-cvr-{date}.csv"
             md_arcname = f"{CLUSTER_NAME}-cvr-{date}.md"
             
-        zip_path = f"{REPORT_DIR}/{zip_filename}"
-        
-        # Create zip file
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            zipf.write(csv_path, arcname=csv_arcname)
-            zipf.write(md_path, arcname=md_arcname)
-            
-        logger.info(f"Created zip file: {zip_path}")
-        
-        # Schedule cleanup
-        background_tasks.add_task(cleanup_file, zip_path)
-        
-        return FileResponse(zip_path, media_type='application/zip', filename=zip_filename)
+        # Build the zip in memory so nothing is written to (or left behind in) REPORT_DIR
+        content = await run_in_threadpool(build_zip, [(csv_path, csv_arcname), (md_path, md_arcname)])
+        logger.info("Created zip file: %s", zip_filename)
+
+        return Response(
+            content=content,
+            media_type='application/zip',
+            headers={'Content-Disposition': f'attachment; filename="{zip_filename}"'}
+        )
 
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
     except HTTPException as he:
         raise he
     except Exception as e:
-        logger.error(f"Error creating zip download: {e}")
+        logger.error("Error creating zip download: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
-async def health_check():
-    return {"status": "ok"}
+async def health_check() -> HealthStatus:
+    return HealthStatus(status="ok")
@@ -1,10 +1,33 @@
 import logging
 import sys
 import csv
-from typing import List, Dict
+import functools
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from operator import itemgetter
+from collections import defaultdict, namedtuple
+from typing import Any, DefaultDict, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union, cast
+import urllib3
 from kubernetes import client, config
 
-def setup_logging():
+logger = logging.getLogger(__name__)
+
+# Wiz report columns used downstream; WizURL is optional in older exports
+WIZ_COLUMNS = ('ImageId', 'AssetName', 'Severity', 'Name', 'WizURL')
+WizRow = namedtuple('WizRow', 'image_id asset_name severity name wiz_url')
+
+# One row per container; K8S_COLUMNS is the matching CSV header
+K8S_COLUMNS = ('NAMESPACE', 'PARENT_KIND', 'PARENT_NAME', 'IMAGE', 'IMAGEID', 'CMDB')
+K8sRow = namedtuple('K8sRow', 'namespace parent_kind parent_name image image_id cmdb')
+
+# Wiz findings by image digest, see build_wiz_index
+WizIndex = Dict[str, Dict[Tuple[str, str], Set[Tuple[str, str]]]]
+
+def setup_logging() -> None:
     """Configure logging for the application."""
     logging.basicConfig(
         level=logging.INFO,
@@ -14,23 +37,87 @@ def setup_logging():
         ]
     )
 
-def fetch_wiz_container_vulnerabilities_report(filepath: str):
-    """Reads the vulnerability report CSV."""
-    logger = logging.getLogger(__name__)
-    logger.info(f"Reading vulnerability report from {filepath}")
+@functools.lru_cache(maxsize=4096)
+def _image_digest(image_id: str) -> str:
+    """Returns the bare digest of an image ID, e.g. 'repo@sha256:abc' or 'docker://sha256:abc' -> 'abc'."""
+    # The same image IDs repeat across containers and Wiz findings, hence the cache
+    _, sep, digest = image_id.rpartition('sha256:')
+    if sep:
+        return digest
+    return image_id.rpartition('@')[2]
+
+def iter_wiz_container_vulnerabilities(filepath: str) -> Iterator[WizRow]:
+    """Yields the used columns of each vulnerability report row, one row at a time."""
+    logger.info("Reading vulnerability report from %s", filepath)
     try:
-        with open(filepath, mode='r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-            logger.info(f"Read {len(rows)} records from vulnerability report")
-            return rows
+        with open(filepath, mode='r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            missing = [c for c in WIZ_COLUMNS[:-1] if c not in header]
+            if missing:
+                logger.error("Vulnerability report %s is missing columns: %s", filepath, ', '.join(missing))
+                return
+
+            image_id_idx, asset_name_idx, severity_idx, name_idx = (header.index(c) for c in WIZ_COLUMNS[:-1])
+            wiz_url_idx = header.index('WizURL') if 'WizURL' in header else None
+            # Rows may carry fewer or more trailing fields than the header; keep every row
+            # long enough to hold the required columns and treat a missing WizURL as empty
+            min_len = max(image_id_idx, asset_name_idx, severity_idx, name_idx) + 1
+            malformed = 0
+            for r in reader:
+                if not r:
+                    continue
+                if len(r) < min_len:
+                    malformed += 1
+                    continue
+                yield WizRow(
+                    r[image_id_idx],
+                    r[asset_name_idx],
+                    r[severity_idx],
+                    r[name_idx],
+                    r[wiz_url_idx] if wiz_url_idx is not None and wiz_url_idx < len(r) else ''
+                )
+
+            # Report skipped rows once rather than per row
+            if malformed:
+                logger.warning("Skipped %d malformed rows in %s", malformed, filepath)
     except FileNotFoundError:
-        logger.error(f"File not found: {filepath}")
-        return []
+        logger.error("File not found: %s", filepath)
+
+def fetch_wiz_container_vulnerabilities_report(filepath: str) -> List[WizRow]:
+    """Reads the vulnerability report CSV, keeping only the columns used by the report."""
+    rows = list(iter_wiz_container_vulnerabilities(filepath))
+    logger.info("Read %s records from vulnerability report", len(rows))
+    return rows
+
+def build_wiz_index(wiz_data: Iterable[WizRow]) -> WizIndex:
+    """Pre-aggregates Wiz findings per image digest: digest -> (AssetName, Severity) -> set of (CVE Name, CVE WizURL).
 
-def get_k8s_client():
+    Each K8s row is then matched with a single lookup and merges whole CVE sets at once.
+    """
+    wiz_by_digest: DefaultDict[str, DefaultDict[Tuple[str, str], Set[Tuple[str, str]]]] = defaultdict(lambda: defaultdict(set))
+    for wiz_row in wiz_data:
+        if wiz_row.image_id:
+            wiz_by_digest[_image_digest(wiz_row.image_id)][(wiz_row.asset_name, wiz_row.severity)].add((wiz_row.name, wiz_row.wiz_url))
+    # Return plain dicts so lookups on the (cached) index can never insert into it
+    return {digest: dict(findings) for digest, findings in wiz_by_digest.items()}
+
+@functools.lru_cache(maxsize=8)
+def _load_wiz_index(filepath: str, mtime_ns: int, size: int) -> WizIndex:
+    # Index straight from the reader so the full list of rows is never held in memory
+    return build_wiz_index(iter_wiz_container_vulnerabilities(filepath))
+
+def load_wiz_index(filepath: str) -> WizIndex:
+    """Returns the Wiz index for a report file, reusing it until the file is modified."""
+    # Key on nanosecond mtime and size so a re-upload within one coarse mtime tick is not missed
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return build_wiz_index(iter_wiz_container_vulnerabilities(filepath))
+    return _load_wiz_index(filepath, st.st_mtime_ns, st.st_size)
+
+def get_k8s_client() -> Optional[client.CoreV1Api]:
     """Loads K8s config and returns CoreV1Api client."""
-    logger = logging.getLogger(__name__)
     try:
         config.load_incluster_config()
         logger.info("Loaded in-cluster config")
@@ -43,102 +130,214 @@ def get_k8s_client():
             return None
     return client.CoreV1Api()
 
-def fetch_k8s_resources() -> List[Dict[str, str]]:
-    """Fetches K8s resources using Kubernetes SDK."""
-    logger = logging.getLogger(__name__)
+
+# Server-side duration of each pod watch request
+WATCH_TIMEOUT_SECONDS = 300
+
+
+class PodCache:
+    """Keeps the container rows of every pod in the cluster in memory, kept current by a K8s watch.
+
+    A background thread lists all pods once, then applies watch events so readers
+    never have to hit the API server. It re-lists whenever the watch falls too far behind.
+    Only the flattened rows are kept per pod, never the raw pod JSON.
+    """
+
+    def __init__(self) -> None:
+        self._pods: Dict[Tuple[str, str], List[K8sRow]] = {}  # (namespace, name) -> container rows of that pod
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.resource_version: Optional[str] = None
+
+    def start(self) -> None:
+        """Starts the watch thread if it is not already running."""
+        self._stopped.clear()
+        if self._thread and self._thread.is_alive():
+            # A thread still draining its last watch after stop() finds the cache unsynced,
+            # so it re-lists and carries on as the watch thread
+            return
+        self._thread = threading.Thread(target=self._run, name="pod-cache", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        """Signals the watch thread to exit, drops the cached pods and waits up to timeout for the thread."""
+        self._stopped.set()
+        with self._lock:
+            self._synced.clear()
+            self._pods = {}
+            self.resource_version = None
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def pods(self) -> Optional[List[List[K8sRow]]]:
+        """Returns a snapshot of the container rows of each cached pod, or None if the cache has not synced yet."""
+        if not self._synced.is_set():
+            return None
+        with self._lock:
+            return list(self._pods.values())
+
+    def _replace(self, pods: Iterable[dict], resource_version: str) -> None:
+        with self._lock:
+            self._pods = {(pod['metadata']['namespace'], pod['metadata']['name']): _pod_container_rows(pod) for pod in pods}
+            self.resource_version = resource_version
+        self._synced.set()
+
+    def _apply_event(self, event_type: str, pod: dict) -> None:
+        key = (pod['metadata']['namespace'], pod['metadata']['name'])
+        with self._lock:
+            # Dropped by stop(); the next list replaces the whole cache anyway
+            if not self._synced.is_set():
+                return
+            if event_type == 'DELETED':
+                self._pods.pop(key, None)
+            else:
+                self._pods[key] = _pod_container_rows(pod)
+            self.resource_version = pod['metadata']['resourceVersion']
+
+    def _watch(self, v1: client.CoreV1Api) -> None:
+        """Applies raw JSON watch events from the last seen resourceVersion until the server ends the watch."""
+        # The client-side read timeout outlasts the server-side one, so a half-open connection
+        # fails the watch (and forces a re-list) instead of blocking the thread forever
+        resp = cast(urllib3.HTTPResponse, v1.list_pod_for_all_namespaces(
+            watch=True, resource_version=self.resource_version, timeout_seconds=WATCH_TIMEOUT_SECONDS,
+            _request_timeout=WATCH_TIMEOUT_SECONDS + 30, _preload_content=False
+        ))
+        try:
+            for line in resp:
+                if self._stopped.is_set() or not self._synced.is_set():
+                    return
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event['type'] == 'ERROR':
+                    raise client.ApiException(status=event['object'].get('code'), reason=event['object'].get('message'))
+                self._apply_event(event['type'], event['object'])
+        finally:
+            resp.release_conn()
+
+    def _run(self) -> None:
+        v1 = get_k8s_client()
+        if not v1:
+            return
+
+        while not self._stopped.is_set():
+            try:
+                pods = list_pods(v1)
+                self._replace(pods['items'], pods['metadata']['resourceVersion'])
+                logger.info("Pod cache synced with %s pods", len(pods['items']))
+
+                # Leave the watch loop to re-list if stop() dropped the cache in the meantime
+                while not self._stopped.is_set() and self._synced.is_set():
+                    self._watch(v1)
+            except client.ApiException as e:
+                if e.status == 410:
+                    logger.info("Pod watch expired, re-listing pods")
+                    continue
+                logger.error("Pod cache watch failed: %s", e)
+                self._stopped.wait(5)
+            except (urllib3.exceptions.ReadTimeoutError, urllib3.exceptions.ProtocolError) as e:
+                logger.info("Pod watch connection lost (%s), re-listing pods", e)
+            except Exception as e:
+                logger.error("Pod cache watch failed: %s", e)
+                self._stopped.wait(5)
+
+
+pod_cache = PodCache()
+
+def list_pods(v1: client.CoreV1Api) -> dict:
+    """Lists pods in all namespaces as the raw JSON PodList.
+
+    Skipping the SDK's model deserialization avoids building a Python object per field.
+    """
+    # With _preload_content=False the SDK returns the raw urllib3 response, not a V1PodList
+    resp = cast(urllib3.HTTPResponse, v1.list_pod_for_all_namespaces(watch=False, _preload_content=False))
+    return json.loads(resp.data)
+
+def _pod_container_rows(pod: dict) -> List[K8sRow]:
+    """Flattens a raw JSON pod into one row per init container and container."""
+    # Values repeat across pods and containers, so intern them to share one string object
+    # (and its cached hash) per distinct value
+    metadata = pod['metadata']
+    status = pod.get('status') or {}
+    namespace = sys.intern(metadata['namespace'])
+
+    # Get parent info
+    parent_kind = "<none>"
+    parent_name = "<none>"
+    owner_references = metadata.get('ownerReferences')
+    if owner_references:
+        parent_kind = sys.intern(owner_references[0]['kind'])
+        parent_name = sys.intern(owner_references[0]['name'])
+
+    # Get labels
+    labels = metadata.get('labels') or {}
+    # Filter for labels containing "cmdb" (case-insensitive)
+    cmdb_labels = ["=".join(item) for item in labels.items() if "cmdb" in item[0].lower()]
+    labels_str = sys.intern(",".join(cmdb_labels)) if cmdb_labels else "NONE"
+
+    # Process Init Containers and Containers in a single pass over the one pod object
+    containers = chain(status.get('initContainerStatuses') or (), status.get('containerStatuses') or ())
+    return [
+        K8sRow(namespace, parent_kind, parent_name, sys.intern(container.get('image') or ''), sys.intern(container.get('imageID') or ''), labels_str)
+        for container in containers
+    ]
+
+def fetch_k8s_pods() -> List[List[K8sRow]]:
+    """Fetches the container rows of each pod from the pod cache, falling back to listing pods via the SDK."""
+    pods = pod_cache.pods()
+    if pods is not None:
+        return pods
+
     v1 = get_k8s_client()
     if not v1:
         return []
 
     logger.info("Fetching pods from all namespaces...")
     try:
-        pods = v1.list_pod_for_all_namespaces(watch=False)
+        return [_pod_container_rows(pod) for pod in list_pods(v1)['items']]
     except client.ApiException as e:
-        logger.error(f"Exception when calling CoreV1Api->list_pod_for_all_namespaces: {e}")
+        logger.error("Exception when calling CoreV1Api->list_pod_for_all_namespaces: %s", e)
         return []
 
-    all_data = []
-    for pod in pods.items:
-        namespace = pod.metadata.namespace
-        
-        # Get parent info
-        parent_kind = "<none>"
-        parent_name = "<none>"
-        if pod.metadata.owner_references:
-            parent_kind = pod.metadata.owner_references[0].kind
-            parent_name = pod.metadata.owner_references[0].name
-            
-        # Get labels
-        labels = pod.metadata.labels if pod.metadata.labels else {}
-        # Filter for labels containing "cmdb" (case-insensitive)
-        cmdb_labels = [f"{k}={v}" for k, v in labels.items() if "cmdb" in k.lower()]
-        labels_str = ",".join(cmdb_labels) if cmdb_labels else "NONE"
-
-        # Process Init Containers
-        if pod.status.init_container_statuses:
-            for status in pod.status.init_container_statuses:
-                all_data.append({
-                    'NAMESPACE': namespace,
-                    'PARENT_KIND': parent_kind,
-                    'PARENT_NAME': parent_name,
-                    'IMAGE': status.image,
-                    'IMAGEID': status.image_id,
-                    'CMDB': labels_str
-                })
-
-        # Process Containers
-        if pod.status.container_statuses:
-            for status in pod.status.container_statuses:
-                all_data.append({
-                    'NAMESPACE': namespace,
-                    'PARENT_KIND': parent_kind,
-                    'PARENT_NAME': parent_name,
-                    'IMAGE': status.image,
-                    'IMAGEID': status.image_id,
-                    'CMDB': labels_str
-                })
-                
-    logger.info(f"Fetched {len(all_data)} container records")
-    return all_data
-
-def save_k8s_resouces_csv(data: List[Dict[str, str]], filepath: str):
+def iter_k8s_resources(pods: Iterable[List[K8sRow]]) -> Iterator[K8sRow]:
+    """Yields one K8sRow per container of the given pods, as returned by fetch_k8s_pods."""
+    fetched = 0
+    for rows in pods:
+        fetched += len(rows)
+        yield from rows
+
+    logger.info("Fetched %s container records", fetched)
+
+def fetch_k8s_resources() -> List[K8sRow]:
+    """Fetches K8s container rows for all pods."""
+    return list(iter_k8s_resources(fetch_k8s_pods()))
+
+def save_k8s_resouces_csv(data: List[K8sRow], filepath: str) -> None:
     """Saves the K8s data to a CSV file."""
-    logger = logging.getLogger(__name__)
     if not data:
         logger.warning("No K8s data to save")
         return
 
-    logger.info(f"Saving K8s report to {filepath}")
-    keys = data[0].keys()
-    
+    logger.info("Saving K8s report to %s", filepath)
     with open(filepath, mode='w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=keys)
-        writer.writeheader()
+        writer = csv.writer(f)
+        writer.writerow(K8S_COLUMNS)
         writer.writerows(data)
     
-    logger.info(f"Saved {len(data)} records to {filepath}")
-
-def cleanse_k8s_resouces_csv(data: List[Dict[str, str]], filepath: str) -> List[Dict[str, str]]:
-    """Cleanses the K8s data CSV file and returns the cleansed data."""
-    logger = logging.getLogger(__name__)
-    if not data:
-        logger.warning("No K8s data to cleanse")
-        return []
+    logger.info("Saved %s records to %s", len(data), filepath)
 
+def iter_cleansed_k8s_resources(data: Iterable[K8sRow]) -> Iterator[K8sRow]:
+    """Yields the K8s rows that have image info, dropping duplicates."""
     logger.info("Cleansing K8s data...")
-    cleansed_data = []
     seen_rows = set()
+    missing_image = 0
 
     for row in data:
-        namespace = row.get('NAMESPACE')
-        parent_kind = row.get('PARENT_KIND')
-        parent_name = row.get('PARENT_NAME')
-        image = row.get('IMAGE', '')
-        image_id = row.get('IMAGEID', '')
-        cmdb = row.get('CMDB', '')
-
         # Skip rows where image info is missing or <none>
-        if not image or image == '<none>' or not image_id or image_id == '<none>':
+        if not row.image or row.image == '<none>' or not row.image_id or row.image_id == '<none>':
+            missing_image += 1
             continue
 
         # Note: SDK returns individual statuses, so no need to split by comma like in kubectl custom-columns
@@ -150,151 +349,115 @@ def cleanse_k8s_resouces_csv(data: List[Dict[str, str]], filepath: str) -> List[
         # "kubectl get pods -A -o custom-columns='NAMESPACE:.metadata.namespace,PARENT_KIND:.metadata.ownerReferences[0].kind,PARENT_NAME:.metadata.ownerReferences[0].name,IMAGE:.status.initContainerStatuses[*].image,IMAGEID:.status.initContainerStatuses[*].imageID'",
         # "kubectl get pods -A -o custom-columns='NAMESPACE:.metadata.namespace,PARENT_KIND:.metadata.ownerReferences[0].kind,PARENT_NAME:.metadata.ownerReferences[0].name,IMAGE:.status.containerStatuses[*].image,IMAGEID:.status.containerStatuses[*].imageID'"
 
-        new_row = {
-            'NAMESPACE': namespace,
-            'PARENT_KIND': parent_kind,
-            'PARENT_NAME': parent_name,
-            'IMAGE': image,
-            'IMAGEID': image_id,
-            'CMDB': cmdb
-        }
-        
-        # Create a tuple for uniqueness check
-        row_tuple = tuple(new_row.items())
-        if row_tuple not in seen_rows:
-            seen_rows.add(row_tuple)
-            cleansed_data.append(new_row)
+        # Rows are plain value tuples, so they are their own uniqueness key
+        if row in seen_rows:
+            continue
+        seen_rows.add(row)
+        yield row
+
+    if missing_image:
+        logger.info("Skipped %d K8s records without image info", missing_image)
+    logger.info("Cleansing complete. Resulting records: %s", len(seen_rows))
+
+def cleanse_k8s_resouces_csv(data: List[K8sRow], filepath: Optional[str] = None) -> List[K8sRow]:
+    """Cleanses the K8s data, saving it to filepath if given, and returns the cleansed data."""
+    if not data:
+        logger.warning("No K8s data to cleanse")
+        return []
+
+    cleansed_data = list(iter_cleansed_k8s_resources(data))
 
-    logger.info(f"Cleansing complete. Resulting records: {len(cleansed_data)}")
-    
     # Save cleansed data
-    if cleansed_data:
-        keys = cleansed_data[0].keys()
-        with open(filepath, mode='w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=keys)
-            writer.writeheader()
-            writer.writerows(cleansed_data)
-        logger.info(f"Saved cleansed data to {filepath}")
-    else:
-        logger.warning("No cleansed data to save")
-        
+    if filepath:
+        save_k8s_resouces_csv(cleansed_data, filepath)
+
     return cleansed_data
 
-def generate_final_report(k8s_data: List[Dict[str, str]], wiz_data: List[Dict[str, str]], output_base_path: str, scan_date: str):
+def _write_report_file(path: str, content: str, **open_kwargs: Any) -> None:
+    """Writes a rendered report to disk."""
+    with open(path, mode='w', encoding='utf-8', **open_kwargs) as f:
+        f.write(content)
+
+def generate_final_report(k8s_data: Iterable[K8sRow], wiz_data: Union[List[WizRow], WizIndex], output_base_path: str, scan_date: str) -> None:
     """Joins K8s and Wiz data, generates CSV and Markdown reports."""
-    logger = logging.getLogger(__name__)
     logger.info("Generating final report...")
     
     # Grouping dictionary: key -> set of (CVE Name, CVE WizURL)
-    grouped_data = {}
+    grouped_data = defaultdict(set)
     
     # Severity order for sorting
     severity_order = {"Critical": 0, "High": 1, "Medium": 2, "Low": 3, "Info": 4}
     
-    for k8s_row in k8s_data:
-        k8s_image_id = k8s_row.get('IMAGEID', '')
-        
-        for wiz_row in wiz_data:
-            wiz_image_id = wiz_row.get('ImageId', '')
-            
-            # Check if K8s ImageID ends with Wiz ImageID
-            if k8s_image_id.endswith(wiz_image_id):
-                # Create a key for grouping (excluding IMAGEID and Name)
-                key = (
-                    k8s_row.get('NAMESPACE'),
-                    k8s_row.get('PARENT_KIND'),
-                    k8s_row.get('PARENT_NAME'),
-                    k8s_row.get('IMAGE'),
-                    wiz_row.get('AssetName'),
-                    wiz_row.get('Severity'),
-                    k8s_row.get('CMDB', '')
-                )
-                
-                if key not in grouped_data:
-                    grouped_data[key] = set()
-                
-                # Add CVE Name and WizURL to the set for this group
-                cve_name = wiz_row.get('Name')
-                cve_wizurl = wiz_row.get('WizURL', '')
-                grouped_data[key].add((cve_name, cve_wizurl))
-
-    # Convert grouped data to list of dicts with CamelCase keys
+    # Accept either Wiz rows or an index already built by build_wiz_index/load_wiz_index
+    wiz_by_digest = wiz_data if isinstance(wiz_data, dict) else build_wiz_index(wiz_data)
+
+    # Unpack each K8s row once so the inner loop only builds tuples
+    for namespace, parent_kind, parent_name, image, image_id, cmdb in k8s_data:
+        findings = wiz_by_digest.get(_image_digest(image_id))
+        if not findings:
+            continue
+
+        for (asset_name, severity), cves in findings.items():
+            # Create a key for grouping (excluding IMAGEID and Name)
+            key = (namespace, parent_kind, parent_name, image, asset_name, severity, cmdb)
+
+            grouped_data[key].update(cves)
+
+    # Convert grouped data to row tuples in report column order, plus a trailing severity rank
     # Requested order: Image, AssetName, Severity, CVEs, Scan Date, Namespace, ParentKind, ParentName, CMDB
     final_rows = []
     cve_counts = {"Critical": 0, "High": 0, "Medium": 0, "Low": 0}
     
-    for key, cves in grouped_data.items():
-        # Sort CVEs by name
-        sorted_cves = sorted(list(cves), key=lambda x: x[0])
-        
-        # Format CVEs as [Name](WizURL)
-        cve_strings = []
-        for name, wizurl in sorted_cves:
-            if wizurl:
-                cve_str = f"[{name}]({wizurl})"
-            else:
-                cve_str = name
-            
-            if cve_str not in cve_strings:
-                cve_strings.append(cve_str)
-        
+    for (namespace, parent_kind, parent_name, image, asset_name, severity, cmdb), cves in grouped_data.items():
+        # Sort CVEs by name (then WizURL, so ties are ordered deterministically) and
+        # format them as [Name](WizURL); dict.fromkeys drops duplicates in order
+        cve_strings = list(dict.fromkeys(
+            f"[{name}]({wizurl})" if wizurl else name for name, wizurl in sorted(cves)
+        ))
+
         # Update counts
-        severity = key[5]
         if severity in cve_counts:
             cve_counts[severity] += len(cve_strings)
-        
-        row = {
-            'Image': key[3],
-            'AssetName': key[4],
-            'Severity': key[5],
-            'CVEs': ", ".join(cve_strings),
-            'Scan Date': scan_date,
-            'Namespace': key[0],
-            'ParentKind': key[1],
-            'ParentName': key[2],
-            'CMDB': key[6]
-        }
-        final_rows.append(row)
+
+        final_rows.append((
+            image, asset_name, severity, ", ".join(cve_strings), scan_date, namespace, parent_kind, parent_name, cmdb,
+            # Rank used only for sorting, not written to the reports
+            severity_order.get(severity, 99)
+        ))
 
     # Sort by Namespace, then AssetName, then Severity
-    final_rows.sort(key=lambda x: (
-        x['Namespace'],
-        x['AssetName'],
-        severity_order.get(x['Severity'], 99)
-    ))
+    final_rows.sort(key=itemgetter(5, 1, 9))
     
-    logger.info(f"Joined and grouped data contains {len(final_rows)} records")
+    logger.info("Joined and grouped data contains %s records", len(final_rows))
     
     if not final_rows:
         logger.warning("No matching vulnerabilities found")
         return
 
-    # Save CSV
-    csv_path = f"{output_base_path}.csv"
+    # Render both reports in memory, then write the two files concurrently
     keys = ['Image', 'AssetName', 'Severity', 'CVEs', 'Scan Date', 'Namespace', 'ParentKind', 'ParentName', 'CMDB']
-    with open(csv_path, mode='w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=keys)
-        writer.writeheader()
-        writer.writerows(final_rows)
-    logger.info(f"Saved final CSV report to {csv_path}")
-    
-    # Save Markdown
+    report_rows = [row[:len(keys)] for row in final_rows]
+    csv_buffer = io.StringIO(newline='')
+    writer = csv.writer(csv_buffer)
+    writer.writerow(keys)
+    writer.writerows(report_rows)
+
+    # Build the whole Markdown document as one string
+    md_parts = ["# Container Vulnerability Report\n\n", "## Severity Summary\n"]
+    md_parts.extend(f"- **{sev}**: {count}\n" for sev, count in cve_counts.items())
+    md_parts.append("\n")
+    md_parts.append("| " + " | ".join(keys) + " |\n")
+    md_parts.append("| " + " | ".join(["---"] * len(keys)) + " |\n")
+    md_parts.extend("| " + " | ".join(map(str, row)) + " |\n" for row in report_rows)
+
+    csv_path = f"{output_base_path}.csv"
     md_path = f"{output_base_path}.md"
-    with open(md_path, mode='w', encoding='utf-8') as f:
-        f.write("# Container Vulnerability Report\n\n")
-        
-        # Write Summary
-        f.write("## Severity Summary\n")
-        for sev, count in cve_counts.items():
-            f.write(f"- **{sev}**: {count}\n")
-        f.write("\n")
-        
-        f.write("| " + " | ".join(keys) + " |\n")
-        f.write("| " + " | ".join(["---"] * len(keys)) + " |\n")
-        
-        # Write rows
-        for row in final_rows:
-            values = [str(row.get(h, '')) for h in keys]
-            f.write("| " + " | ".join(values) + " |\n")
-            
-    logger.info(f"Saved final Markdown report to {md_path}")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(_write_report_file, csv_path, csv_buffer.getvalue(), newline=''),
+            executor.submit(_write_report_file, md_path, "".join(md_parts)),
+        ]
+        for future in futures:
+            future.result()
+    logger.info("Saved final CSV report to %s", csv_path)
+    logger.info("Saved final Markdown report to %s", md_path)
@@ -1,7 +1,15 @@
+import asyncio
+import io
+import os
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+import zipfile
+import httpx
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
-from pccs_cvr.app import app
+from unittest.mock import patch
+from pccs_cvr.app import app, pod_cache, load_report_index
 
 client = TestClient(app)
 
@@ -10,45 +18,145 @@ def mock_env_vars(monkeypatch):
     monkeypatch.setenv("DATA_DIR", "/tmp/data_cvr")
     monkeypatch.setenv("CLUSTER_NAME", "test-cluster")
 
+def write_reports(k8s_data, wiz_index, output_base_path, scan_date):
+    """Stands in for generate_final_report, creating empty report files."""
+    for ext in ("csv", "md"):
+        open(f"{output_base_path}.{ext}", "w").close()
+
+@pytest.fixture
+def cvr_env(tmp_path):
+    """Runs /cvr against tmp_path with a 2025-01-01 Wiz upload, a known pod resourceVersion and mocked K8s and report steps."""
+    wiz_csv = tmp_path / "2025-01-01-wiz.csv"
+    wiz_csv.write_text("ImageId\n", encoding='utf-8')
+
+    # Fresh locks: on Python 3.9 an asyncio.Lock stays bound to the loop it was first used in,
+    # and each TestClient (or asyncio.run) call may run on a different loop
+    with patch("pccs_cvr.app.RAW_DIR", str(tmp_path)), patch("pccs_cvr.app.REPORT_DIR", str(tmp_path)), \
+            patch("pccs_cvr.app.report_signatures", {}), patch("pccs_cvr.app.KNOWN_REPORT_DATES", set()) as known_dates, \
+            patch("pccs_cvr.app.report_locks", defaultdict(asyncio.Lock)), patch.object(pod_cache, "resource_version", "42"), \
+            patch("pccs_cvr.app.fetch_k8s_pods", return_value=[]) as mock_k8s, patch("pccs_cvr.app.load_wiz_index") as mock_wiz, \
+            patch("pccs_cvr.app.generate_final_report", side_effect=write_reports) as mock_gen_report:
+        yield SimpleNamespace(
+            dir=tmp_path, wiz_csv=wiz_csv, known_dates=known_dates,
+            fetch_k8s_pods=mock_k8s, load_wiz_index=mock_wiz, generate_final_report=mock_gen_report
+        )
+
 def test_health_check():
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok"}
 
+@patch("pccs_cvr.app.KNOWN_REPORT_DATES", set())
 @patch("pccs_cvr.app.os.listdir")
 def test_get_all_reports(mock_listdir):
-    mock_listdir.return_value = ["2025-01-01-cvr.csv", "2025-01-02-cvr.csv"]
+    mock_listdir.return_value = ["2025-01-01-cvr.csv", "2025-01-02-cvr.csv", "2025-01-02-cvr.md"]
+    load_report_index()
     response = client.get("/reports/all")
     assert response.status_code == 200
     assert "2025-01-01" in response.json()["dates"]
     assert "2025-01-02" in response.json()["dates"]
 
-@patch("pccs_cvr.app.fetch_k8s_resources")
-@patch("pccs_cvr.app.fetch_wiz_container_vulnerabilities_report")
-@patch("pccs_cvr.app.generate_final_report")
-@patch("pccs_cvr.app.cleanse_k8s_resouces_csv")
-@patch("builtins.open", new_callable=MagicMock)
-@patch("os.path.exists")
-def test_generate_report(mock_exists, mock_open, mock_cleanse, mock_gen_report, mock_wiz, mock_k8s):
-    # Mock existence checks
-    # 1. report csv exists? False
-    # 2. wiz csv exists? True
-    mock_exists.side_effect = [False, True] 
-    
-    mock_k8s.return_value = [{'key': 'value'}]
-    mock_cleanse.return_value = [{'key': 'value'}]
-    mock_wiz.return_value = [{'key': 'value'}]
-    
+def test_get_all_reports_picks_up_reports_from_other_replicas(tmp_path):
+    (tmp_path / "2025-01-01-cvr.csv").write_text("csv", encoding='utf-8')
+    with patch("pccs_cvr.app.REPORT_DIR", str(tmp_path)), patch("pccs_cvr.app.KNOWN_REPORT_DATES", set()):
+        load_report_index()
+        assert client.get("/reports/all").json()["dates"] == ["2025-01-01"]
+
+        # Written by another replica sharing the volume
+        (tmp_path / "2025-01-02-cvr.csv").write_text("csv", encoding='utf-8')
+        st = os.stat(tmp_path)
+        os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        assert client.get("/reports/all").json()["dates"] == ["2025-01-01", "2025-01-02"]
+
+def test_generate_report(cvr_env):
     response = client.post("/cvr", json={"date": "2025-01-01"})
     
     assert response.status_code == 200
     assert "Report generated successfully" in response.json()["message"]
     
-    mock_k8s.assert_called_once()
-    mock_gen_report.assert_called_once()
+    cvr_env.fetch_k8s_pods.assert_called_once()
+    cvr_env.generate_final_report.assert_called_once()
+    assert cvr_env.known_dates == {"2025-01-01"}
 
 @patch("os.path.exists")
 def test_download_zip_not_found(mock_exists):
     mock_exists.return_value = False
     response = client.get("/download/2025-01-01")
     assert response.status_code == 404
+
+def test_upload_file(tmp_path):
+    with patch("pccs_cvr.app.RAW_DIR", str(tmp_path)):
+        response = client.post("/upload", files={"file": ("wiz.csv", b"ImageId,Name\nsha256:abc,CVE-1\n", "text/csv")})
+
+    assert response.status_code == 200
+    uploaded = tmp_path / response.json()["filename"].rsplit("/", 1)[-1]
+    assert uploaded.read_bytes() == b"ImageId,Name\nsha256:abc,CVE-1\n"
+
+def test_generate_report_skips_unchanged_inputs(cvr_env):
+    assert client.post("/cvr", json={"date": "2025-01-01"}).status_code == 200
+    assert client.post("/cvr", json={"date": "2025-01-01"}).status_code == 200
+    cvr_env.generate_final_report.assert_called_once()
+
+    # A missing Markdown report is regenerated even though the inputs are unchanged
+    (cvr_env.dir / "2025-01-01-cvr.md").unlink()
+    assert client.post("/cvr", json={"date": "2025-01-01"}).status_code == 200
+
+    assert cvr_env.generate_final_report.call_count == 2
+    assert (cvr_env.dir / "2025-01-01-cvr.md").exists()
+    assert (cvr_env.dir / "2025-01-01-cvr.sig").exists()
+    assert cvr_env.known_dates == {"2025-01-01"}
+
+def test_generate_report_regenerates_same_mtime_reupload(cvr_env):
+    mtime_ns = cvr_env.wiz_csv.stat().st_mtime_ns
+    assert client.post("/cvr", json={"date": "2025-01-01"}).status_code == 200
+
+    # Re-upload within the same mtime tick
+    cvr_env.wiz_csv.write_text("ImageId,Name\n", encoding='utf-8')
+    os.utime(cvr_env.wiz_csv, ns=(mtime_ns, mtime_ns))
+    assert client.post("/cvr", json={"date": "2025-01-01"}).status_code == 200
+
+    assert cvr_env.generate_final_report.call_count == 2
+
+def test_generate_report_serializes_same_date(cvr_env):
+    running = []
+
+    def generate(k8s, wiz, base, date):
+        running.append(date)
+        assert len(running) == 1, "report generation overlapped"
+        time.sleep(0.05)
+        running.pop()
+
+    # Writes no report files, so the second request cannot be skipped as unchanged
+    cvr_env.generate_final_report.side_effect = generate
+
+    async def post_twice():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+            return await asyncio.gather(*(async_client.post("/cvr", json={"date": "2025-01-01"}) for _ in range(2)))
+
+    responses = asyncio.run(post_twice())
+
+    assert [r.status_code for r in responses] == [200, 200]
+    assert cvr_env.generate_final_report.call_count == 2
+
+def test_get_report(tmp_path):
+    (tmp_path / "2025-01-01-cvr.csv").write_text("Image,AssetName\nimg1,asset1\n", encoding='utf-8')
+    with patch("pccs_cvr.app.REPORT_DIR", str(tmp_path)):
+        response = client.get("/reports/2025-01-01")
+        missing = client.get("/reports/2025-01-02")
+
+    assert response.status_code == 200
+    assert response.text == "Image,AssetName\nimg1,asset1\n"
+    assert missing.status_code == 404
+
+def test_download_zip(tmp_path):
+    (tmp_path / "2020-01-01-cvr.csv").write_text("csv", encoding='utf-8')
+    (tmp_path / "2020-01-01-cvr.md").write_text("md", encoding='utf-8')
+    with patch("pccs_cvr.app.REPORT_DIR", str(tmp_path)), patch("pccs_cvr.app.CLUSTER_NAME", "test-cluster"):
+        response = client.get("/download/2020-01-01")
+
+    assert response.status_code == 200
+    assert 'filename="test-cluster-cvr-2020-01-01.zip"' in response.headers["content-disposition"]
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zipf:
+        assert sorted(zipf.namelist()) == ["test-cluster-cvr-2020-01-01.csv", "test-cluster-cvr-2020-01-01.md"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["2020-01-01-cvr.csv", "2020-01-01-cvr.md"]
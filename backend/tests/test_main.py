@@ -1,31 +1,33 @@
-from unittest.mock import patch, mock_open
-from pccs_cvr.main import cleanse_k8s_resouces_csv, generate_final_report
+import json
+import os
+from unittest.mock import patch, mock_open, MagicMock
+from pccs_cvr.main import K8sRow, PodCache, WizRow, cleanse_k8s_resouces_csv, generate_final_report, fetch_k8s_resources, fetch_wiz_container_vulnerabilities_report, iter_cleansed_k8s_resources, iter_k8s_resources, iter_wiz_container_vulnerabilities, load_wiz_index
 
 def test_cleanse_k8s_resouces_csv():
     # Input data with duplicates and missing fields
     data = [
-        {'NAMESPACE': 'ns1', 'PARENT_KIND': 'Deployment', 'PARENT_NAME': 'dep1', 'IMAGE': 'img1', 'IMAGEID': 'id1', 'CMDB': 'cmdb1'},
-        {'NAMESPACE': 'ns1', 'PARENT_KIND': 'Deployment', 'PARENT_NAME': 'dep1', 'IMAGE': 'img1', 'IMAGEID': 'id1', 'CMDB': 'cmdb1'}, # Duplicate
-        {'NAMESPACE': 'ns2', 'PARENT_KIND': 'Pod', 'PARENT_NAME': 'pod1', 'IMAGE': '', 'IMAGEID': 'id2', 'CMDB': 'cmdb2'}, # Missing Image
-        {'NAMESPACE': 'ns3', 'PARENT_KIND': 'DaemonSet', 'PARENT_NAME': 'ds1', 'IMAGE': 'img3', 'IMAGEID': 'id3', 'CMDB': 'cmdb3'},
+        K8sRow('ns1', 'Deployment', 'dep1', 'img1', 'id1', 'cmdb1'),
+        K8sRow('ns1', 'Deployment', 'dep1', 'img1', 'id1', 'cmdb1'), # Duplicate
+        K8sRow('ns2', 'Pod', 'pod1', '', 'id2', 'cmdb2'), # Missing Image
+        K8sRow('ns3', 'DaemonSet', 'ds1', 'img3', 'id3', 'cmdb3'),
     ]
     
     with patch("builtins.open", mock_open()) as mock_file:
         cleansed = cleanse_k8s_resouces_csv(data, "dummy_path.csv")
         
         assert len(cleansed) == 2
-        assert cleansed[0]['NAMESPACE'] == 'ns1'
-        assert cleansed[1]['NAMESPACE'] == 'ns3'
+        assert cleansed[0].namespace == 'ns1'
+        assert cleansed[1].namespace == 'ns3'
         
         # Verify file write
         mock_file.assert_called_with("dummy_path.csv", mode='w', newline='', encoding='utf-8')
 
 def test_generate_final_report():
     k8s_data = [
-        {'NAMESPACE': 'ns1', 'PARENT_KIND': 'Deployment', 'PARENT_NAME': 'dep1', 'IMAGE': 'img1', 'IMAGEID': 'sha256:1234567890', 'CMDB': 'cmdb1'}
+        K8sRow('ns1', 'Deployment', 'dep1', 'img1', 'sha256:1234567890', 'cmdb1')
     ]
     wiz_data = [
-        {'ImageId': '1234567890', 'AssetName': 'asset1', 'Severity': 'Critical', 'Name': 'CVE-1', 'WizURL': 'https://app.wiz.io/'}
+        WizRow('1234567890', 'asset1', 'Critical', 'CVE-1', 'https://app.wiz.io/')
     ]
     
     with patch("builtins.open", mock_open()) as mock_file:
@@ -35,3 +37,185 @@ def test_generate_final_report():
         assert mock_file.call_count == 2
         mock_file.assert_any_call("dummy_report.csv", mode='w', newline='', encoding='utf-8')
         mock_file.assert_any_call("dummy_report.md", mode='w', encoding='utf-8')
+
+def test_generate_final_report_matches_by_digest(tmp_path):
+    k8s_data = [
+        K8sRow('ns1', 'Deployment', 'dep1', 'repo/img1:v1', 'repo/img1@sha256:abc123', 'cmdb1'),
+        K8sRow('ns2', 'Deployment', 'dep2', 'repo/img2:v1', 'repo/img2@sha256:def456', 'cmdb2'),
+        K8sRow('ns3', 'Deployment', 'dep3', 'repo/img3:v1', 'docker://sha256:fed789', 'cmdb3'),  # Docker runtime form
+    ]
+    wiz_data = [
+        WizRow('sha256:abc123', 'asset1', 'High', 'CVE-2', ''),
+        WizRow('sha256:abc123', 'asset1', 'High', 'CVE-1', ''),
+        WizRow('sha256:999999', 'asset3', 'Low', 'CVE-3', ''),
+        WizRow('sha256:fed789', 'asset2', 'Medium', 'CVE-4', ''),
+    ]
+
+    output_base_path = str(tmp_path / "report")
+    generate_final_report(k8s_data, wiz_data, output_base_path, "2025-01-01")
+
+    with open(f"{output_base_path}.csv", encoding='utf-8') as f:
+        lines = f.read().splitlines()
+
+    assert lines[1:] == [
+        'repo/img1:v1,asset1,High,"CVE-1, CVE-2",2025-01-01,ns1,Deployment,dep1,cmdb1',
+        'repo/img3:v1,asset2,Medium,CVE-4,2025-01-01,ns3,Deployment,dep3,cmdb3',
+    ]
+
+def test_fetch_wiz_container_vulnerabilities_report(tmp_path):
+    wiz_csv = tmp_path / "wiz.csv"
+    wiz_csv.write_text(
+        "ID,Name,Severity,WizURL,AssetName,ImageId,Package Name\n"
+        "1,CVE-1,Critical,https://app.wiz.io/1,asset1,sha256:abc123,openssl\n",
+        encoding='utf-8'
+    )
+
+    rows = fetch_wiz_container_vulnerabilities_report(str(wiz_csv))
+
+    assert rows == [WizRow('sha256:abc123', 'asset1', 'Critical', 'CVE-1', 'https://app.wiz.io/1')]
+
+def test_fetch_wiz_container_vulnerabilities_report_skips_short_rows(tmp_path, caplog):
+    wiz_csv = tmp_path / "wiz.csv"
+    wiz_csv.write_text(
+        "ImageId,AssetName,Severity,Name,WizURL\n"
+        "sha256:abc123,asset1,High,CVE-1,https://app.wiz.io/1\n"
+        "sha256:abc123,asset1,High,CVE-2\n"  # Missing trailing WizURL
+        "\n"
+        "sha256:abc123,asset1,High,CVE-3,https://app.wiz.io/3,extra\n"
+        "sha256:abc123,asset1\n",  # Too short to hold Severity and Name
+        encoding='utf-8'
+    )
+
+    rows = fetch_wiz_container_vulnerabilities_report(str(wiz_csv))
+
+    assert rows == [
+        WizRow('sha256:abc123', 'asset1', 'High', 'CVE-1', 'https://app.wiz.io/1'),
+        WizRow('sha256:abc123', 'asset1', 'High', 'CVE-2', ''),
+        WizRow('sha256:abc123', 'asset1', 'High', 'CVE-3', 'https://app.wiz.io/3'),
+    ]
+    assert [r.getMessage() for r in caplog.records if r.levelname == 'WARNING'] == [f"Skipped 1 malformed rows in {wiz_csv}"]
+
+def _pod(namespace, name, image_id):
+    return {
+        'metadata': {'namespace': namespace, 'name': name, 'resourceVersion': '1', 'labels': {'cmdb_id': 'CI1'}},
+        'status': {'containerStatuses': [{'image': 'img', 'imageID': image_id}]},
+    }
+
+def test_pod_cache_serves_fetch_k8s_resources():
+    cache = PodCache()
+    assert cache.pods() is None
+
+    cache._replace([_pod('ns1', 'pod1', 'id1'), _pod('ns1', 'pod2', 'id2')], '1')
+    cache._apply_event('MODIFIED', _pod('ns1', 'pod1', 'id3'))
+    cache._apply_event('DELETED', _pod('ns1', 'pod2', 'id2'))
+
+    with patch("pccs_cvr.main.pod_cache", cache), patch("pccs_cvr.main.get_k8s_client") as mock_client:
+        rows = fetch_k8s_resources()
+
+    mock_client.assert_not_called()
+    assert rows == [K8sRow('ns1', '<none>', '<none>', 'img', 'id3', 'cmdb_id=CI1')]
+
+def test_load_wiz_index_reuses_unchanged_file(tmp_path):
+    wiz_csv = tmp_path / "wiz.csv"
+    wiz_csv.write_text("ImageId,AssetName,Severity,Name\nsha256:abc123,asset1,High,CVE-1\n", encoding='utf-8')
+
+    with patch("pccs_cvr.main.iter_wiz_container_vulnerabilities", wraps=iter_wiz_container_vulnerabilities) as mock_fetch:
+        index = load_wiz_index(str(wiz_csv))
+        assert load_wiz_index(str(wiz_csv)) is index
+
+    mock_fetch.assert_called_once()
+    assert index == {'abc123': {('asset1', 'High'): {('CVE-1', '')}}}
+
+def test_load_wiz_index_reloads_same_mtime_reupload(tmp_path):
+    wiz_csv = tmp_path / "wiz.csv"
+    wiz_csv.write_text("ImageId,AssetName,Severity,Name\nsha256:abc123,asset1,High,CVE-1\n", encoding='utf-8')
+    mtime_ns = wiz_csv.stat().st_mtime_ns
+    load_wiz_index(str(wiz_csv))
+
+    # Re-upload within the same mtime tick
+    wiz_csv.write_text("ImageId,AssetName,Severity,Name\nsha256:abc123,asset1,High,CVE-10\n", encoding='utf-8')
+    os.utime(wiz_csv, ns=(mtime_ns, mtime_ns))
+
+    assert load_wiz_index(str(wiz_csv)) == {'abc123': {('asset1', 'High'): {('CVE-10', '')}}}
+
+def test_generate_final_report_requires_exact_digest(tmp_path):
+    k8s_data = [
+        K8sRow('ns1', 'Deployment', 'dep1', 'repo/img1:v1', 'repo/img1@sha256:abc123', 'cmdb1')
+    ]
+    wiz_data = [
+        WizRow('', 'asset1', 'High', 'CVE-1', ''),  # No ImageId
+        WizRow('sha256:c123', 'asset1', 'High', 'CVE-2', ''),  # Only a suffix of the digest
+    ]
+
+    generate_final_report(k8s_data, wiz_data, str(tmp_path / "report"), "2025-01-01")
+
+    assert list(tmp_path.iterdir()) == []
+
+def test_generate_final_report_streams_cleansed_pods(tmp_path):
+    # pod1 and pod2 run the same image without an owner, so their rows are duplicates
+    cache = PodCache()
+    cache._replace([_pod('ns1', 'pod1', 'img@sha256:abc123'), _pod('ns1', 'pod2', 'img@sha256:abc123'), _pod('ns1', 'pod3', '<none>')], '1')
+    wiz_data = [WizRow('sha256:abc123', 'asset1', 'High', 'CVE-1', '')]
+
+    output_base_path = str(tmp_path / "report")
+    generate_final_report(iter_cleansed_k8s_resources(iter_k8s_resources(cache.pods())), wiz_data, output_base_path, "2025-01-01")
+
+    with open(f"{output_base_path}.csv", encoding='utf-8') as f:
+        lines = f.read().splitlines()
+
+    assert lines[1:] == ['img,asset1,High,CVE-1,2025-01-01,ns1,<none>,<none>,cmdb_id=CI1']
+
+def test_fetch_k8s_resources_lists_raw_pods():
+    pod_list = {'metadata': {'resourceVersion': '7'}, 'items': [{
+        'metadata': {'namespace': 'ns1', 'name': 'pod1', 'ownerReferences': [{'kind': 'ReplicaSet', 'name': 'rs1'}], 'labels': {'app': 'web'}},
+        'status': {
+            'initContainerStatuses': [{'image': 'init', 'imageID': 'init@sha256:111'}],
+            'containerStatuses': [{'image': 'app', 'imageID': 'app@sha256:222'}],
+        },
+    }]}
+    v1 = MagicMock()
+    v1.list_pod_for_all_namespaces.return_value.data = json.dumps(pod_list).encode()
+
+    with patch("pccs_cvr.main.pod_cache", PodCache()), patch("pccs_cvr.main.get_k8s_client", return_value=v1):
+        rows = fetch_k8s_resources()
+
+    v1.list_pod_for_all_namespaces.assert_called_once_with(watch=False, _preload_content=False)
+    assert rows == [
+        K8sRow('ns1', 'ReplicaSet', 'rs1', 'init', 'init@sha256:111', 'NONE'),
+        K8sRow('ns1', 'ReplicaSet', 'rs1', 'app', 'app@sha256:222', 'NONE'),
+    ]
+
+def test_pod_cache_applies_watch_events():
+    cache = PodCache()
+    cache._replace([_pod('ns1', 'pod1', 'id1')], '1')
+    events = [
+        {'type': 'ADDED', 'object': _pod('ns1', 'pod2', 'id2')},
+        {'type': 'DELETED', 'object': _pod('ns1', 'pod1', 'id1')},
+    ]
+    v1 = MagicMock()
+    v1.list_pod_for_all_namespaces.return_value.__iter__.return_value = [json.dumps(e).encode() + b"\n" for e in events]
+
+    cache._watch(v1)
+
+    assert cache.pods() == [[K8sRow('ns1', '<none>', '<none>', 'img', 'id2', 'cmdb_id=CI1')]]
+    assert v1.list_pod_for_all_namespaces.call_args.kwargs['_request_timeout'] > v1.list_pod_for_all_namespaces.call_args.kwargs['timeout_seconds']
+
+def test_pod_cache_stop_drops_pods_and_start_restarts():
+    cache = PodCache()
+    with patch("pccs_cvr.main.get_k8s_client", return_value=None):
+        cache.start()
+        cache._thread.join(1)
+        cache._replace([_pod('ns1', 'pod1', 'id1')], '1')
+        first_thread = cache._thread
+
+        cache.stop()
+        assert cache.pods() is None
+        assert cache.resource_version is None
+        cache._apply_event('ADDED', _pod('ns1', 'pod2', 'id2'))
+        assert cache._pods == {}
+
+        cache.start()
+        cache._thread.join(1)
+
+    assert cache._thread is not first_thread
+    assert not cache._stopped.is_set()